@@ -5,8 +5,14 @@
 # - 区切り線は | :--- | 形式
 # - <table>…</table> のみMarkdownに置換し、他のテキストは完全保持
 
+import io
+import re
 from html.parser import HTMLParser
 
+# <table の開始位置と、それ以降で最初の </table>（ネストしない前提）
+_TABLE_OPEN_RE = re.compile(r"<table\b", re.IGNORECASE)
+_TABLE_CLOSE_RE = re.compile(r"</table\s*>", re.IGNORECASE)
+
 def main(inputs=None, context=None, **kwargs):
     # Dify Codeノードの引数受けに幅を持たせる
     inputs = inputs or {}
@@ -26,45 +32,49 @@ def replace_tables_in_place(html: str) -> str:
     if not html:
         return ""
 
-    out_parts = []
+    buf = io.StringIO()
+    buf.writelines(iter_markdown(html))
+    return buf.getvalue()
+
+
+def iter_markdown(html: str):
+    """
+    replace_tables_in_place のストリーム版。非テーブル部分とテーブル1つ分の
+    Markdownを順に yield する（全体を連結した文字列を持たない）。
+    ファイルやソケットへ逐次書き出す呼び出し側向け。
+    """
+    if not html:
+        return
+
     pos = 0
-    lower = html.lower()
 
+    # 小文字化コピーを作らず、大文字小文字を無視した検索で開始→終了を探す
     while True:
-        start = lower.find("<table", pos)
-        if start == -1:
-            # 以降はテーブルなし：残りをそのまま出力
-            out_parts.append(html[pos:])
-            break
-
-        # テーブル開始までを出力（そのまま保持）
-        out_parts.append(html[pos:start])
+        m = _TABLE_OPEN_RE.search(html, pos)
+        if m is None:
+            break  # 以降はテーブルなし
 
         # 開始タグの '>' を探す（属性を含む場合に備え）
-        gt = lower.find(">", start)
-        if gt == -1:
-            # 破損したHTML。安全のため残り全部を出して終了
-            out_parts.append(html[start:])
-            break
-
-        # 対応する </table> を探す（ネストしない前提）
-        end_tag = "</table>"
-        end = lower.find(end_tag, gt + 1)
-        if end == -1:
-            # 閉じタグが無い：残り全部を出して終了
-            out_parts.append(html[start:])
+        gt = html.find(">", m.end())
+        # 対応する </table> を探す
+        end = _TABLE_CLOSE_RE.search(html, gt + 1) if gt != -1 else None
+        if end is None:
+            # 破損・閉じタグ無し：残り全部をそのまま出して終了
+            # （後続の<table>ごとに末尾まで探し直さない）
             break
-        table_html = html[start : end + len(end_tag)]
 
-        # 1テーブル分をMarkdownへ
-        md = table_html_to_markdown(table_html)
+        # テーブル開始までを出力（そのまま保持）
+        if m.start() > pos:
+            yield html[pos:m.start()]
 
-        # 置換
-        out_parts.append(md)
+        # 1テーブル分をMarkdownへ置換
+        yield table_html_to_markdown(html[m.start():end.end()])
 
-        pos = end + len(end_tag)
+        pos = end.end()
 
-    return "".join(out_parts)
+    # 残りをそのまま出力
+    if pos < len(html):
+        yield html[pos:]
 
 # ========= 2) 1つの<table>HTMLをMarkdown表に変換 =========
 
@@ -78,7 +88,9 @@ def table_html_to_markdown(table_html: str) -> str:
     if not parser.tables:
         return table_html  # パース失敗時は安全に原文返し
     table = parser.tables[0]
-    return _table_to_markdown(table)
+    if parser.plain:
+        return _plain_table_to_markdown(table)
+    return table_to_markdown(table)
 
 # ========= 3) HTMLパーサ（標準ライブラリ） =========
 
@@ -89,143 +101,254 @@ class TableParser(HTMLParser):
         self._cur_table = None
         self._cur_row = None
         self._cur_cell = None
-        self._cell_text = ""
+        self._cell_chunks = []  # handle_data断片（+= 連結の再確保を避ける）
+        # rowspan/colspan属性・<th>が1つも無ければ True（展開不要の単純表）
+        self.plain = True
 
     def handle_starttag(self, tag, attrs):
-        t = tag.lower()
-        if t == "table":
+        # タグ名・属性名は HTMLParser が小文字化済み
+        if tag == "table":
             self._cur_table = []
-        elif t == "tr":
+        elif tag == "tr":
             if self._cur_table is not None:
                 self._cur_row = []
-        elif t in ("td", "th"):
+        elif tag in ("td", "th"):
             if self._cur_row is not None:
-                self._cur_cell = {"text": "", "rowspan": 1, "colspan": 1, "is_header": (t == "th")}
+                self._cur_cell = {"text": "", "rowspan": 1, "colspan": 1, "is_header": (tag == "th")}
+                if tag == "th":
+                    self.plain = False
                 for k, v in attrs:
-                    k = k.lower()
                     if k == "rowspan":
-                        try:
-                            self._cur_cell["rowspan"] = int(v)
-                        except Exception:
-                            pass
+                        self._cur_cell["rowspan"] = parse_span(v)
+                        self.plain = False
                     elif k == "colspan":
-                        try:
-                            self._cur_cell["colspan"] = int(v)
-                        except Exception:
-                            pass
-                self._cell_text = ""
+                        self._cur_cell["colspan"] = parse_span(v)
+                        self.plain = False
+                self._cell_chunks = []
 
     def handle_endtag(self, tag):
-        t = tag.lower()
-        if t in ("td", "th"):
+        if tag in ("td", "th"):
             if self._cur_cell is not None:
-                self._cur_cell["text"] = (self._cell_text or "").strip()
+                self._cur_cell["text"] = "".join(self._cell_chunks).strip()
                 self._cur_row.append(self._cur_cell)
                 self._cur_cell = None
-        elif t == "tr":
+        elif tag == "tr":
             if self._cur_table is not None and self._cur_row is not None:
                 self._cur_table.append(self._cur_row)
             self._cur_row = None
-        elif t == "table":
+        elif tag == "table":
             if self._cur_table is not None:
                 self.tables.append(self._cur_table)
             self._cur_table = None
 
     def handle_data(self, data):
         if self._cur_cell is not None:
-            self._cell_text += data
+            self._cell_chunks.append(data)
 
 # ========= 4) テーブル構造をMarkdownへ（結合展開＋ヘッダ連結） =========
+# main.py（lxml版）もここを共用する。セル辞書 {"text", "rowspan",
+# "colspan", "is_header"} の行配列さえ作れば、以降の処理は共通。
+# "text" は前後の空白を除去済みであること（どちらのパーサもstrip済み）。
 
-def _table_to_markdown(table) -> str:
+def table_to_markdown(table) -> str:
     """
     TableParserが作った 'table' 構造（行ごとのセル辞書配列）をMarkdownへ。
     - rowspan/colspan をグリッドに展開
     - 先頭から連続する<th>行をヘッダ層として '親 > 子' に連結
     """
-    # --- rowspan/colspan 展開 ---
+    header_layers = count_header_layers(table)
+    grid, texts, max_cols = build_grid(table, header_layers)
+    headers = flatten_headers(grid[:header_layers], texts, max_cols)
+    body = grid[header_layers:]
+    return to_markdown(headers, body)
+
+
+def _plain_table_to_markdown(table) -> str:
+    """
+    rowspan/colspan/<th> を含まない表の近道。
+    結合展開もヘッダ連結も要らないので、セルを左詰めに並べて col_N ヘッダを付ける。
+    """
+    grid = [[_normalize_text(cell["text"] or "") for cell in row] for row in table]
+
+    max_cols = max(map(len, grid), default=0)
+    for row_vals in grid:
+        if len(row_vals) < max_cols:
+            row_vals += [""] * (max_cols - len(row_vals))
+
+    headers = [f"col_{i+1}" for i in range(max_cols)]
+    return to_markdown(headers, grid)
+
+
+_NO_CARRY = {}  # rowspanの無い表で使う空の予約（読むだけで書き込まない）
+
+
+def build_grid(table, header_layers: int = 0):
+    """
+    rowspan/colspan を展開し、全行を同じ列数に揃えた2次元グリッドを返す。
+    戻り値は (grid, texts, max_cols)。
+    - 本文行（header_layers 行目以降）の値はセル文字列、埋め草は ""
+    - ヘッダ行の値はセルID k（文字列は texts[k]、0 は ""）。rowspanで
+      下に伸びた位置は上と同じ k になり、ヘッダ連結の重複判定に使う
+    """
+    texts = [""]
     grid = []
-    carry = {}  # (r, c) -> text  上からのrowspanで埋めるべき値
+    n_rows = len(table)
+    # 行ごとの {c: 値}  上からのrowspanで埋めるべき値（タプルキーを作らない）
+    # rowspan>1 のセルが初めて出た時点で作る（無い表では行ごとのdictを作らない）
+    carry_rows = None
     max_cols = 0
+    est_cols = 0  # 直前の行の列数。次の行はこの幅で確保しておく
 
     for r_idx, row in enumerate(table):
-        row_vals = []
+        by_id = r_idx < header_layers
+        if r_idx == header_layers and r_idx and carry_rows:
+            # ヘッダから本文へ伸びるrowspan予約をIDから文字列へ
+            for pending in carry_rows[r_idx:]:
+                for c in pending:
+                    pending[c] = texts[pending[c]]
+        fill = 0 if by_id else ""
+
+        # 埋め草で確保済みなので、colspanの埋め草は書き込み不要
+        row_vals = [fill] * est_cols
+        w = 0  # 書き込み位置（確保済み領域を超える時だけ伸ばす）
         c_idx = 0
+        carry = carry_rows[r_idx] if carry_rows else _NO_CARRY
 
         # 上段からのrowspan予約セルを先に配置
-        while (r_idx, c_idx) in carry:
-            row_vals.append(carry.pop((r_idx, c_idx)))
+        while c_idx in carry:
+            if w == len(row_vals):
+                row_vals.append(carry.pop(c_idx))
+            else:
+                row_vals[w] = carry.pop(c_idx)
+            w += 1
             c_idx += 1
 
         for cell in row:
-            text = (cell["text"] or "").replace("\n", "<br>")
+            v = _normalize_text(cell["text"] or "")
+            if by_id:
+                texts.append(v)
+                v = len(texts) - 1
             rs, cs = cell["rowspan"], cell["colspan"]
 
-            row_vals.append(text)
-            for _ in range(cs - 1):
-                row_vals.append("")
+            span = cs if cs > 1 else 1  # セル本体＋colspan埋め草の数
+            grow = w + span - len(row_vals)
+            if grow > 0:
+                row_vals.extend([fill] * grow)
+            row_vals[w] = v
+            w += span
 
             if rs > 1:
-                left = len(row_vals) - cs
-                for dr in range(1, rs):
+                if carry_rows is None:
+                    carry_rows = [{} for _ in range(n_rows)]
+                left = w - cs
+                # 表の最終行を超える予約は使われないので作らない
+                for below in carry_rows[r_idx + 1 : r_idx + rs]:
                     for dc in range(cs):
-                        carry[(r_idx + dr, left + dc)] = text if dc == 0 else ""
+                        below[left + dc] = v if dc == 0 else fill
 
             c_idx += cs
             # 進んだ位置にも予約があれば即配置
-            while (r_idx, c_idx) in carry:
-                row_vals.append(carry.pop((r_idx, c_idx)))
+            while c_idx in carry:
+                if w == len(row_vals):
+                    row_vals.append(carry.pop(c_idx))
+                else:
+                    row_vals[w] = carry.pop(c_idx)
+                w += 1
                 c_idx += 1
 
-        max_cols = max(max_cols, len(row_vals))
+        max_cols = max(max_cols, w)
+        est_cols = w
         grid.append(row_vals)
 
-    # 列幅を揃える
-    for row in grid:
-        row += [""] * (max_cols - len(row))
+    # 列幅を揃える（確保幅が max_cols に満たない行だけ）
+    for r_idx, row_vals in enumerate(grid):
+        if len(row_vals) < max_cols:
+            row_vals += [0 if r_idx < header_layers else ""] * (max_cols - len(row_vals))
 
-    # --- ヘッダ層の数（連続<th>行） ---
+    return grid, texts, max_cols
+
+
+def count_header_layers(table) -> int:
+    """
+    先頭から連続する<th>を含む行の数（ヘッダ層の数）。
+    """
     header_layers = 0
     for row in table:
-        if any(c["is_header"] for c in row):
-            header_layers += 1
+        # any() のジェネレータを行ごとに作らず、最初の<th>で抜ける
+        for c in row:
+            if c["is_header"]:
+                break
         else:
-            break
+            break  # <th>の無い行でヘッダ層は終わり
+        header_layers += 1
+    return header_layers
+
 
-    # --- ヘッダ連結：左伝播でcolspanグループ化、rowspan重複は結合スキップ ---
+def flatten_headers(layers, texts, max_cols: int):
+    """
+    ヘッダ層（build_grid のセルIDの行）を1行に連結：
+    左伝播でcolspanグループ化、rowspan重複は結合スキップ。
+    重複判定はまずセルIDで行い（rowspanで下に伸びた位置は上と同じID）、
+    別セルでも直前と同じ文字列なら結合しない。
+    """
     headers = [""] * max_cols
-    prev_seg = [None] * max_cols
+    prev_id = [0] * max_cols
 
-    for r in range(min(header_layers, len(grid))):
-        layer = grid[r]
-        propagated = [""] * max_cols
-        current = ""
+    for layer in layers:
+        propagated = [0] * max_cols  # 各列が連結するセルID（0 は無し）
+        current = 0
         for c in range(max_cols):
-            if layer[c].strip():
-                current = layer[c].strip()
+            k = layer[c]
+            if texts[k]:
+                current = k
             propagated[c] = current
 
         for c in range(max_cols):
-            seg = propagated[c]
-            if not seg:
+            k = propagated[c]
+            if not k:
                 continue
-            if prev_seg[c] == seg:
-                continue  # rowspan重複
+            seg = texts[k]
+            p = prev_id[c]
+            if p == k or (p and texts[p] == seg):
+                continue  # rowspan重複・同名ヘッダの繰り返し
             headers[c] = seg if not headers[c] else f"{headers[c]} > {seg}"
-            prev_seg[c] = seg
+            prev_id[c] = k
 
     # 未命名列を連番
     for i in range(max_cols):
         if not headers[i]:
             headers[i] = f"col_{i+1}"
 
-    body = grid[header_layers:]
+    return headers
 
-    # --- Markdown整形（:--- 区切り） ---
-    lines = []
-    lines.append("| " + " | ".join(headers) + " |")
-    lines.append("| " + " | ".join([":---"] * max_cols) + " |")
+
+def to_markdown(headers, body) -> str:
+    """
+    GFM表（:--- 区切り）を出力。body の各行は列数が揃っている前提
+    （行ごとの切り詰め・補完はしない）。
+    """
+    # 行ごとの文字列を作らず、全断片を1回のjoinで連結
+    parts = ["| ", " | ".join(headers), " |\n| ", " | ".join([":---"] * len(headers)), " |"]
     for row in body:
-        row = row[:max_cols]
-        lines.append("| " + " | ".join(row) + " |")
-    return "\n".join(lines)
\ No newline at end of file
+        parts.append("\n| ")
+        parts.append(" | ".join(row))
+        parts.append(" |")
+    return "".join(parts)
+
+# ========= 5) 小物 =========
+
+def parse_span(v) -> int:
+    """
+    rowspan/colspan 属性値を整数へ。不正値・欠落は 1。
+    """
+    try:
+        return int(v)
+    except Exception:
+        return 1
+
+
+def _normalize_text(s: str) -> str:
+    """
+    セル内の改行を '<br>' に正規化（'|' はエスケープしない）。
+    """
+    return s.replace("\n", "<br>") if "\n" in s else s
@@ -1,6 +1,17 @@
 from __future__ import annotations
-from bs4 import BeautifulSoup
-from typing import List, Tuple
+from typing import Any, Dict, List
+
+from lxml import etree
+
+from dify import parse_span, table_to_markdown
+
+# Built once and reused for every call (libxml2 HTML parser, tolerant of broken markup).
+# Input is fed as UTF-8 bytes: lxml rejects str input that carries an
+# <?xml ... encoding=...?> declaration.
+_HTML_PARSER = etree.HTMLParser(encoding="utf-8", recover=True)
+
+# Elements whose text is code, not content (BeautifulSoup's get_text skips them too)
+_NON_TEXT_TAGS = frozenset(("script", "style"))
 
 # ------------------------------------------------------------------------------
 # Public API
@@ -20,163 +31,79 @@ def html_table_to_flat_markdown(html: str) -> str:
     Returns:
       Markdown string. If no table exists, returns an empty string.
     """
-    soup = BeautifulSoup(html, "html.parser")
-    table = soup.find("table")
+    root = etree.fromstring(html.encode("utf-8"), _HTML_PARSER) if html else None
+    if root is None:
+        return ""
+    table = next(root.iter("table"), None)
     if table is None:
         return ""
 
-    grid = _build_grid_with_spans(table)
-    header_rows = _count_header_layers(table)
-    headers = _flatten_header_layers(grid, header_rows)
-    body = grid[header_rows:] if header_rows < len(grid) else []
-
-    return _to_markdown(headers, body)
+    return table_to_markdown(_table_rows(table))
 
 
 # ------------------------------------------------------------------------------
 # Core steps
 # ------------------------------------------------------------------------------
 
-def _build_grid_with_spans(table) -> List[List[str]]:
+def _table_rows(table) -> List[List[Dict[str, Any]]]:
     """
-    Build a 2D grid of strings from an HTML table, resolving rowspan/colspan.
-    Cell text newlines are normalized to '<br>'.
+    Adapt an lxml <table> element into the row/cell-dict structure shared with
+    dify.py ({"text", "rowspan", "colspan", "is_header"} per cell), so grid
+    expansion, header flattening and emission run through one code path.
     """
-    rows = table.find_all("tr")
-    grid: List[List[str]] = []
-    carry: dict[Tuple[int, int], str] = {}  # cells reserved by rowspan from above
-    max_cols = 0
-
-    for r_idx, tr in enumerate(rows):
-        cells = tr.find_all(["td", "th"], recursive=False)
-        row_vals: List[str] = []
-        c_idx = 0
-
-        # Place any cells coming from previous rowspans
-        while (r_idx, c_idx) in carry:
-            row_vals.append(carry.pop((r_idx, c_idx)))
-            c_idx += 1
-
-        for cell in cells:
-            text = _normalize_text(cell.get_text("\n", strip=True))
-            rs = int(cell.get("rowspan", 1) or 1)
-            cs = int(cell.get("colspan", 1) or 1)
-
-            # Place top-left of this cell, then pad horizontally for colspan
-            row_vals.append(text)
-            for _ in range(cs - 1):
-                row_vals.append("")
-
-            # Reserve vertical extensions for rowspan
-            if rs > 1:
-                leftmost = len(row_vals) - cs
-                for dr in range(1, rs):
-                    for dc in range(cs):
-                        # Only the leftmost column of this span carries the text
-                        carry[(r_idx + dr, leftmost + dc)] = text if dc == 0 else ""
-
-            c_idx += cs
+    rows: List[List[Dict[str, Any]]] = []
+    for tr in _own_rows(table):
+        row: List[Dict[str, Any]] = []
+        for cell in tr.iterchildren("td", "th"):
+            row.append({
+                "text": _cell_text(cell),
+                "rowspan": parse_span(cell.get("rowspan", 1)),
+                "colspan": parse_span(cell.get("colspan", 1)),
+                "is_header": cell.tag == "th",
+            })
+        rows.append(row)
+    return rows
 
-            # If new positions are already reserved by upper rowspans, place them
-            while (r_idx, c_idx) in carry:
-                row_vals.append(carry.pop((r_idx, c_idx)))
-                c_idx += 1
-
-        max_cols = max(max_cols, len(row_vals))
-        grid.append(row_vals)
-
-    # Make all rows the same width
-    for row in grid:
-        row += [""] * (max_cols - len(row))
-
-    return grid
 
+# ------------------------------------------------------------------------------
+# Small utilities
+# ------------------------------------------------------------------------------
 
-def _count_header_layers(table) -> int:
+def _own_rows(table):
     """
-    Count how many leading <tr> are header layers (contain at least one <th>).
+    Yield the table's own <tr> elements (directly or via thead/tbody/tfoot),
+    without descending into tables nested inside cells.
     """
-    count = 0
-    for tr in table.find_all("tr", recursive=False):
-        has_th = any(cell.name == "th" for cell in tr.find_all(["td", "th"], recursive=False))
-        if has_th:
-            count += 1
+    for child in table.iterchildren("tr", "thead", "tbody", "tfoot"):
+        if child.tag == "tr":
+            yield child
         else:
-            break
-    return count
+            yield from child.iterchildren("tr")
 
 
-def _flatten_header_layers(grid: List[List[str]], header_layers: int) -> List[str]:
+def _cell_text(cell) -> str:
     """
-    Flatten multi-row headers into a single row using 'Parent > Child'.
-    - Propagate the last non-empty header text to the right in each header layer
-      (to reflect colspan grouping).
-    - Avoid duplicate joins when the same text repeats via rowspan.
+    Text of a cell with each text node stripped and joined by newlines
+    (empty nodes dropped), matching BeautifulSoup's get_text("\\n", strip=True):
+    <script>/<style> contents and comments are skipped, their tails are kept.
     """
-    if not grid:
-        return []
-
-    cols = len(grid[0])
-    headers = ["" for _ in range(cols)]
-    prev_seg_per_col: List[str | None] = [None for _ in range(cols)]
-
-    layers = min(header_layers, len(grid))
-    for r in range(layers):
-        layer = grid[r]
-
-        # Propagate the last non-empty segment to the right (colspan effect)
-        propagated = [""] * cols
-        current = ""
-        for c in range(cols):
-            if layer[c].strip():
-                current = layer[c].strip()
-            propagated[c] = current
-
-        # Join per column, skipping duplicates from rowspan
-        for c in range(cols):
-            seg = propagated[c]
-            if not seg:
-                continue
-            if prev_seg_per_col[c] == seg:
-                # same text coming from rowspan above -> skip duplicate
-                continue
-            headers[c] = seg if not headers[c] else f"{headers[c]} > {seg}"
-            prev_seg_per_col[c] = seg
-
-    # Fill unnamed columns
-    for i in range(cols):
-        if not headers[i]:
-            headers[i] = f"col_{i+1}"
-
-    return headers
-
-
-def _to_markdown(headers: List[str], body_rows: List[List[str]]) -> str:
-    """
-    Emit a GFM table with ':---' alignment separators.
-    """
-    sep = ":---"
-    lines = []
-    lines.append("| " + " | ".join(headers) + " |")
-    lines.append("| " + " | ".join([sep] * len(headers)) + " |")
-    for row in body_rows:
-        # Ensure correct column count
-        row = row[:len(headers)] + [""] * max(0, len(headers) - len(row))
-        lines.append("| " + " | ".join(row) + " |")
-    return "\n".join(lines)
-
+    chunks: List[str] = []
+    _collect_text(cell, chunks)
+    return "\n".join(t for t in (s.strip() for s in chunks) if t)
 
-# ------------------------------------------------------------------------------
-# Small utilities
-# ------------------------------------------------------------------------------
 
-def _normalize_text(s: str) -> str:
+def _collect_text(el, chunks: List[str]) -> None:
     """
-    Normalize cell text:
-      - Convert embedded newlines to '<br>' for Markdown renderers.
-      - (Intentionally NOT escaping '|' to keep behavior identical to previous version.)
+    Append el's text and its descendants' text/tails in document order.
     """
-    return s.replace("\n", "<br>")
+    if el.text:
+        chunks.append(el.text)
+    for child in el:
+        # Comments/PIs have a non-str tag; only their tail is content
+        if isinstance(child.tag, str) and child.tag not in _NON_TEXT_TAGS:
+            _collect_text(child, chunks)
+        if child.tail:
+            chunks.append(child.tail)
 
 
 # ------------------------------------------------------------------------------